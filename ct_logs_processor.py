@@ -22,14 +22,35 @@ from __future__ import print_function
 
 import ast
 import csv
+import json
+import operator
 import os
 import re
 import sys
 import traceback
 import argparse
+import functools
+import multiprocessing
 from collections import defaultdict
 from pprint import pprint
 
+# Marks the start of the histogram dump; everything before it is skipped.
+_MERGE_RE = re.compile(br'Merging \d+ csv files into \d+ columns')
+
+# The exec.go:83 prefix that the logger adds to continuation lines of the
+# histogram dump. [^\]]* stops at the closing "]" of the log header instead of
+# scanning to the end of the long dump line and backtracking.
+# NOTE: The line number of 83 here may change. Please fix it if to be the
+# right number if it does so.
+# TODO: Automate finding this line number.
+_EXEC_PREFIX_RE = re.compile(br'I[^\]]*exec\.go:83\] exec\.go:83 ')
+
+# A whole line from another log source, for example util.go, exec.go:223 etc.
+_GO_LINE_RE = re.compile(br'I[^\]]*?\.go:\d+\] .*?\.go:\d+')
+
+# The new lines are already removed when this runs, so no re.DOTALL.
+_ROWS_RE = re.compile(br'For rows: (.*?)Avg row is')
+
 
 class TraceUrlMismatch(Exception):
   def __init__(self, expected_url, found_url, metric_name, run_index):
@@ -40,7 +61,21 @@ class TraceUrlMismatch(Exception):
     print("Storyset repeat: ", run_index)
 
 
+# Takes the histograms as the raw bytes from the log.
 def string_to_list(string):
+  # The rows are Python literals. If no string in them contains a double
+  # quote, every string is single quoted with no quotes inside, so swapping
+  # the quotes gives the same data as JSON, which parses much faster than
+  # ast.literal_eval. Anything JSON can't express (None, tuples, \x escapes
+  # etc.) fails to decode and falls back to ast.literal_eval.
+  # json.loads decodes the bytes itself, so they are only decoded here for the
+  # fallback.
+  if b'"' not in string:
+    try:
+      return json.loads(string.replace(b"'", b'"'))
+    except ValueError:
+      pass
+  string = string.decode('utf-8')
   try:
     # ast.literal_eval only parses static data so safer than eval.
     return ast.literal_eval(string)
@@ -50,101 +85,151 @@ def string_to_list(string):
 
 
 # Histograms are referred to a "rows" in CT logs.
-def get_histograms(filename):
-  output = []
-  with open(filename) as f:
-    # Iterate until you find the merge log line.
+# Yields them one at a time, so only one "For rows" block is parsed at once.
+def iter_histograms(filename):
+  histograms_processed = 0
+  with open(filename, 'rb') as f:
+    # Iterate until you find the merge log line. The substring check rejects
+    # most lines before the regex runs.
     while True:
       line = f.readline()
-      if line == '':
-        return output  # Reached EOF. No histograms in this file.
-      if re.search('Merging \d+ csv files into \d+ columns', line):
+      if line == b'':
+        return  # Reached EOF. No histograms in this file.
+      if b'Merging ' in line and _MERGE_RE.search(line):
         break
 
-    # Read the rest of the file.
-    logs = f.read()
-    # First I remove the exec.go:83 prefix from some lines, because in the logs
-    # they look like this:
+    # Read the rest of the file line by line and splice the histogram dump
+    # back together. Dump lines in the logs look like this:
     # ["For rows: [{'productVersions': '', 'osVersi
     # I0105 18:10:08.017015   26595 exec.go:83] exec.go:83 ons': 'M', ...
-    # NOTE: The line number of 83 here may change. Please fix it if to be the
-    # right number if it does so.
-    # TODO: Automate finding this line number.
-    logs = re.sub('\nI.*exec\.go\:83] exec\.go\:83 ', '\n', logs)
-    # Then I remove all lines that are not from other log sources, for example,
-    # util.go, exec.go:223 etc.
-    logs = re.sub('\nI.*?\.go\:\d+] .*?\.go\:\d+.*?(?=\n)', '\n', logs)
-    # Then I remove all new lines.
-    logs = re.sub('\n', '', logs);
-
-    for histograms_str in re.findall("For rows: (.*?)Avg row is",
-                                     logs, re.DOTALL):
-      output.extend(string_to_list(histograms_str))
-
-  print("%d histograms processed." % len(output))
-  return output
-
-
-# Returns url -> run_index -> dict of metrics
+    # so I remove the exec.go:83 prefix, drop lines from other log sources and
+    # remove all new lines. Only lines starting with "I" and containing ".go:"
+    # can be Go log lines, so the regexes only run on those.
+    logs = bytearray()
+    for line in f:
+      if line.startswith(b'I') and b'.go:' in line:
+        exec_prefix = _EXEC_PREFIX_RE.match(line)
+        if exec_prefix:
+          line = line[exec_prefix.end():]
+        elif _GO_LINE_RE.match(line):
+          continue
+      logs += line.rstrip(b'\r\n')
+
+    for match in _ROWS_RE.finditer(logs):
+      # bytes() because the match of a bytearray is a bytearray, which
+      # python2's json.loads rejects.
+      histograms = string_to_list(bytes(match.group(1)))
+      histograms_processed += len(histograms)
+      for histogram in histograms:
+        yield histogram
+
+  print("%d histograms processed." % histograms_processed)
+
+
+# The fields get_run_results uses from histograms it keeps, fetched in a
+# single call.
+_get_histogram_fields = operator.itemgetter(
+    'name', 'stories', 'storysetRepeats', 'traceUrls')
+
+
+# Returns (url, run_index) -> dict of metrics
 def get_run_results(ct_histograms):
-  url_to_run_index_to_rows = defaultdict(lambda: defaultdict(dict))
+  rows = {}
+  story_run_to_row = {}
   fieldnames = set(['page_name', 'run_index', 'trace_url'])
   stats = {'more_than_one_value': defaultdict(int)}
+  more_than_one_value = stats['more_than_one_value']
 
   for histogram in ct_histograms:
-    if histogram['avg'] == '': continue
-    if int(histogram['count']) < 1: continue
+    avg = histogram['avg']
+    if avg == '': continue
+    count = int(histogram['count'])
+    if count < 1: continue
 
-    metric_name = histogram['name']
-    # Stories can be like "https://google.com (#12)".
-    # Strip the story number at the end.
-    url = histogram['stories'].split("(")[0].strip()
-    run_index = int(histogram['storysetRepeats'])
+    (metric_name, stories, storyset_repeats,
+     trace_url) = _get_histogram_fields(histogram)
 
-    if histogram['count'] > '1':
+    if count > 1:
       # Track this case.
-      stats['more_than_one_value'][metric_name] += 1
-
-    metric_value = float(histogram['avg'])
-    metrics_dict = url_to_run_index_to_rows[url][run_index]
-    metrics_dict['page_name'] = url
-    metrics_dict[metric_name] = float(metric_value)
-    trace_url = histogram['traceUrls']
-    if 'trace_url' in metrics_dict:
+      more_than_one_value[metric_name] += 1
+
+    # Every metric of a story run is a separate histogram with the same
+    # stories and storysetRepeats, so only parse them the first time.
+    story_run = (stories, storyset_repeats)
+    metrics_dict = story_run_to_row.get(story_run)
+    if metrics_dict is None:
+      # Stories can be like "https://google.com (#12)".
+      # Strip the story number at the end.
+      url = stories.split("(")[0].strip()
+      run_index = int(storyset_repeats)
+      metrics_dict = rows.get((url, run_index))
+      if metrics_dict is None:
+        metrics_dict = rows[(url, run_index)] = {
+            'page_name': url, 'run_index': run_index, 'trace_url': trace_url}
+      story_run_to_row[story_run] = metrics_dict
+    if metrics_dict['trace_url'] != trace_url:
       # All histograms for the same url and run index should have the same
       # trace url.
-      if (metrics_dict['trace_url'] != trace_url):
-        raise TraceUrlMismatch(metrics_dict['trace_url'], trace_url,
-                               metric_name, run_index)
-    else:
-      metrics_dict['trace_url'] = trace_url
+      raise TraceUrlMismatch(metrics_dict['trace_url'], trace_url,
+                             metric_name, metrics_dict['run_index'])
+    metrics_dict[metric_name] = float(avg)
     fieldnames.add(metric_name)
-  return {'run_results': url_to_run_index_to_rows, 'fieldnames': fieldnames}
+  return {'run_results': rows, 'fieldnames': fieldnames}
+
+
+# Yields each dict row as a tuple in fieldnames order. Not every row has every
+# metric, missing cells are left empty like csv.DictWriter does.
+def rows_as_tuples(rows, fieldnames):
+  blank_row = dict.fromkeys(fieldnames, '')
+  get_cells = operator.itemgetter(*fieldnames)
+  for row in rows:
+    filled_row = blank_row.copy()
+    filled_row.update(row)
+    yield get_cells(filled_row)
 
 
 def write_results_to_csv(out_filename, run_results, fieldnames):
-  rows = 0
-  with open(out_filename, 'w') as f:
-    writer = csv.DictWriter(f, fieldnames)
-    writer.writeheader()
-    for run_index_to_metrics in run_results.values():
-      all_runs = run_index_to_metrics.values()
-      for run_result in all_runs:
-        writer.writerow(run_result)
-        rows += 1
+  fieldnames = list(fieldnames)
+  rows = len(run_results)
+  with open(out_filename, 'w', 1 << 20) as f:
+    writer = csv.writer(f)
+    writer.writerow(fieldnames)
+    writer.writerows(rows_as_tuples(run_results.values(), fieldnames))
   print("Wrote %d rows to %s" % (rows, out_filename))
 
 
+# Each input file is parsed in its own process by the functions below, so
+# they must stay at module level to be picklable.
+def transform_file(input_file, outdir):
+  print("Processing " + input_file)
+  basename, _ = os.path.splitext(input_file)
+  output_file = os.path.join(outdir, basename + ".csv")
+  results = get_run_results(iter_histograms(input_file))
+  write_results_to_csv(output_file, **results)
+
+
+def load_run_results(input_file):
+  print("Processing " + input_file)
+  return get_run_results(iter_histograms(input_file))
+
+
+# Returns the results of func on each item, computed in up to jobs processes.
+# Pool isn't a context manager in python2, hence the try/finally.
+def map_in_processes(func, items, jobs):
+  pool = multiprocessing.Pool(jobs)
+  try:
+    return pool.map(func, items)
+  finally:
+    pool.close()
+    pool.join()
+
+
 def transform_single_file(args):
   if not os.path.exists(args.outdir):
     os.makedirs(args.outdir, mode=0o755)
 
-  for input_file in args.input_files:
-    print("Processing " + input_file)
-    basename, _ = os.path.splitext(input_file)
-    output_file = os.path.join(args.outdir, basename + ".csv")
-    results = get_run_results(get_histograms(input_file))
-    write_results_to_csv(output_file, **results)
+  map_in_processes(functools.partial(transform_file, outdir=args.outdir),
+                   args.input_files, args.jobs)
 
   # Not using f-strings to keep compatibility with python2.
   print("Transformed %d files to csv." % len(args.input_files))
@@ -152,32 +237,30 @@ def transform_single_file(args):
 
 def transform_and_merge(args):
   out_filename = args.merge
-  all_results = []
 
-  for input_file in args.input_files:
-    print("Processing " + input_file)
-    basename, _ = os.path.splitext(input_file)
-    output_file = os.path.join(args.outdir, basename + ".csv")
-    all_results.append(get_run_results(get_histograms(input_file)))
+  all_results = map_in_processes(load_run_results, args.input_files, args.jobs)
 
-  all_fieldnames = set()
-  for fieldnames in [x['fieldnames'] for x in all_results]:
-    all_fieldnames.union(fieldnames)
+  # Files can have different metrics, so write the union of all columns.
+  all_fieldnames = list(set().union(*[x['fieldnames'] for x in all_results]))
 
   rows = 0
-  with open(out_filename, 'w') as f:
-    writer = csv.DictWriter(f, list(fieldnames))
-    writer.writeheader()
+  with open(out_filename, 'w', 1 << 20) as f:
+    writer = csv.writer(f)
+    writer.writerow(all_fieldnames)
     for run_results in [x['run_results'] for x in all_results]:
-      for run_index_to_metrics in run_results.values():
-        all_runs = run_index_to_metrics.values()
-        for run_result in all_runs:
-          rows += 1
-          writer.writerow(run_result)
+      rows += len(run_results)
+      writer.writerows(rows_as_tuples(run_results.values(), all_fieldnames))
 
   print("Wrote %d rows to %s" % (rows, out_filename))
 
 
+def positive_int(value):
+  number = int(value)
+  if number < 1:
+    raise argparse.ArgumentTypeError("must be at least 1, got %s" % value)
+  return number
+
+
 def main():
   argparser = argparse.ArgumentParser(
     description="Transform a cluster telemetry log file to csv.")
@@ -186,6 +269,11 @@ def main():
   argparser.add_argument('--merge', nargs='?', const="merged.csv",
                          metavar="MERGED_FILENAME",
                          help="merge all outputs into one csv")
+  argparser.add_argument("-j", "--jobs", type=positive_int,
+                         help="""number of files to process in parallel.
+                         Progress lines of files processed in parallel may
+                         interleave; use -j 1 for ordered output.
+                         Default: number of CPUs""")
   argparser.add_argument("input_files", nargs="+",
                          help="""Path to one or more input files. Output
                          filenames are deduced by replacing the extension with
@@ -4,8 +4,11 @@ from google.cloud import storage
 
 import argparse
 import csv
+import functools
+import operator
 import os
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 VAR_NAME = 'VOLT_CT_CLIENT_SECRETS'
 secrets_path = os.environ.get(VAR_NAME)
@@ -27,6 +30,8 @@ credentials = appflow.credentials
 
 CSV_OUTPUT_DIR = 'csv-outputs'
 MAX_QUERY_LIMIT = 1000
+# Downloads are network bound, so many can be in flight at once.
+MAX_DOWNLOAD_THREADS = 32
 TS_PROPERTY = 'TsCompleted'
 
 # Map of original column names -> modified column names.
@@ -40,15 +45,30 @@ COLUMN_MAP = {
 
 FINAL_FIELDS = ('url trace run_date_str FCP TBT CLS LCP').split(' ')
 
-def CleanRow(input_row):
-  output_row = {
-    'url': input_row['page_name'].split(' ')[0],
-    'run_date_str': input_row['run_date_str']
-  }
+def MakeRowCleaner(header, run_date_str):
+  """Returns a function mapping a CSV row to its FINAL_FIELDS values, in order.
+
+  Column positions only depend on the header, so they are resolved once per
+  file instead of for every row.
+  """
+  header_len = len(header)
+  url_index = header.index('page_name')
+  # The cleaned url, run_date_str and an empty cell are appended to each row.
+  # Sometimes a column is missing in older CSVs, so those read the empty cell.
+  column_index = {column: i for (i, column) in enumerate(header)}
+  final_field_index = {'url': header_len, 'run_date_str': header_len + 1}
   for (input_col, output_col) in COLUMN_MAP.items():
-    # .get because sometimes a column is missing in older CSVs.
-    output_row[output_col] = input_row.get(input_col, None)
-  return output_row
+    final_field_index[output_col] = column_index.get(input_col, header_len + 2)
+  get_final_fields = operator.itemgetter(
+      *[final_field_index[field] for field in FINAL_FIELDS])
+
+  def CleanRow(row):
+    if len(row) < header_len:
+      row.extend([''] * (header_len - len(row)))
+    row[header_len:] = (row[url_index].split(' ', 1)[0], run_date_str, '')
+    return get_final_fields(row)
+
+  return CleanRow
 
 
 def DateStingToCtTime(date_str):
@@ -60,11 +80,11 @@ def DateStingToCtTime(date_str):
     return None
 
   try:
-    (year, month, day) = date_str.split('-')
+    (year, month, day) = map(int, date_str.split('-'))
   except ValueError:
     raise Exception("Date in incorrect format. Use yyyy-mm-dd")
 
-  return int(f'{year}{month}{day}000000')
+  return year * 10_000_000_000 + month * 100_000_000 + day * 1_000_000
 
 
 def GetAllVoltRuns(since_str, group_name):
@@ -84,11 +104,16 @@ def GetAllVoltRuns(since_str, group_name):
 
 
 def CtTimeToDateString(ct_time):
-  time_str = str(ct_time)
-  year = time_str[:4]
-  month = time_str[4:6]
-  day = time_str[6:8]
-  return f"{year}-{month}-{day}"
+  """Converts yyyymmddhhmmss int to yyyy-mm-dd string."""
+  (year, month_day) = divmod(ct_time // 1_000_000, 10_000)
+  (month, day) = divmod(month_day, 100)
+  return f"{year:04d}-{month:02d}-{day:02d}"
+
+
+def DownloadBlob(storage_client, blob_url, download_path):
+  with open(download_path, 'wb') as f:
+    storage_client.download_blob_to_file(blob_url, f)
+    print('Downloaded csv to ' + download_path)
 
 
 def DownloadOutputs(runs, group_name):
@@ -98,6 +123,8 @@ def DownloadOutputs(runs, group_name):
   storage_client = storage.Client(
       project='chrome-speed-metrics-analysis',
       credentials=credentials)
+  blob_urls = []
+  download_paths = []
   for run in runs:
     date_str = str(run[TS_PROPERTY])
     raw_output = run['RawOutput']
@@ -109,44 +136,54 @@ def DownloadOutputs(runs, group_name):
     if pathlib.Path(download_path).exists():
       print(f'{download_path} already exists. Skipping download.')
       continue
-    with open(download_path, 'wb') as f:
-      storage_client.download_blob_to_file(blob_url, f)
-      print('Downloaded csv to ' + download_path)
+    blob_urls.append(blob_url)
+    download_paths.append(download_path)
+
+  # The client is shared by all threads.
+  with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_THREADS) as executor:
+    # list() to re-raise any exception from the downloads.
+    list(executor.map(functools.partial(DownloadBlob, storage_client),
+                      blob_urls, download_paths))
 
 
 def AddDateAndMergeCsvs(merged_filename, group_name, since_str):
-  # NOTE: We first accumulate all the rows because there is no guarantee
-  # that every CSV will have the same field names. If memory becomes an issue
-  # change this to only read the header of each file.
+  # Every row is cleaned to FINAL_FIELDS, so the output columns don't depend
+  # on the columns of each CSV and rows can be written as they are read.
   dir_path = os.path.join(CSV_OUTPUT_DIR, group_name)
   all_csvs = pathlib.Path(dir_path).glob('*')
-  all_fields = {'ct_raw_ts_completed', 'run_date_str'}
-  all_rows = []
   since_int = DateStingToCtTime(since_str)
   files_processed = 0
-
-  for csv_file in all_csvs:
-    # Check if file is greater than since
-    date_str = csv_file.name.split('.')[0]
-    date_int = int(date_str)
-    if since_int is not None and date_int < since_int:
-      continue
-    files_processed += 1
-    with open(csv_file) as f:
-      reader = csv.DictReader(f)
-      for row in reader:
-        row['ct_raw_ts_completed'] = date_int
-        row['run_date_str'] = CtTimeToDateString(date_int)
-        cleaned_row = CleanRow(row)
-        all_rows.append(cleaned_row)
-      all_fields.update(reader.fieldnames)
-
-  with open(merged_filename, 'w') as f:
-    writer = csv.DictWriter(f, FINAL_FIELDS)
-    writer.writeheader()
-    writer.writerows(all_rows)
-    print(f'Processed {files_processed} files.')
-    print(f'Wrote {len(all_rows)} rows into {merged_filename}')
+  rows_written = 0
+
+  with open(merged_filename, 'w', newline='', buffering=1 << 20) as out:
+    writer = csv.writer(out)
+    writer.writerow(FINAL_FIELDS)
+    for csv_file in all_csvs:
+      # Check if file is greater than since
+      date_str = csv_file.name.split('.')[0]
+      date_int = int(date_str)
+      if since_int is not None and date_int < since_int:
+        continue
+      files_processed += 1
+      # Every row of a file comes from the same run.
+      run_date_str = CtTimeToDateString(date_int)
+      with open(csv_file, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+          continue
+        if 'page_name' not in header:
+          print(f'No page_name column in {csv_file} | Skipping.')
+          continue
+        clean_row = MakeRowCleaner(header, run_date_str)
+        for row in reader:
+          if not row:
+            continue  # Blank line.
+          writer.writerow(clean_row(row))
+          rows_written += 1
+
+  print(f'Processed {files_processed} files.')
+  print(f'Wrote {rows_written} rows into {merged_filename}')
 
 
 def Main():